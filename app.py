@@ -1,15 +1,18 @@
 import argparse
+import bisect
+import collections
+import contextlib
 import datasets.transforms as T
-import io
-import matplotlib.pyplot as plt
+import functools
+import hashlib
 import numpy as np
 import random
-import scipy.ndimage as ndimage
 import torch
+import torch.nn.functional as F
 
 from PIL import Image
 from util.slconfig import SLConfig, DictAction
-from util.misc import nested_tensor_from_tensor_list
+from util.misc import NestedTensor, nested_tensor_from_tensor_list
 
 # Suppress warnings to avoid overflowing the log.
 import warnings
@@ -17,6 +20,12 @@ warnings.filterwarnings("ignore")
 
 
 CONF_THRESH = 0.23
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+FEATURE_CACHE_SIZE = 8
+TEXT_CACHE_SIZE = 8
+# (short side, long side) inputs are padded to when the backbone is compiled.
+CANONICAL_SIZE = (800, 1333)
 
 # MODEL:
 def get_args_parser():
@@ -77,6 +86,12 @@ def get_args_parser():
         "--local-rank", type=int, help="local rank for DistributedDataParallel"
     )
     parser.add_argument("--amp", action="store_true", help="Train with mixed precision")
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the backbone for inference; call warmup() after moving the "
+        "model to its device, or the first request pays the whole compile cost",
+    )
     return parser
 
 def get_device():
@@ -87,13 +102,12 @@ def get_device():
 
 # Get counting model.
 def build_model_and_transforms(args):
-    normalize = T.Compose(
-        [T.ToTensor(), T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])]
-    )
+    # Resize the uint8 PIL image before it is converted to a float tensor.
+    # Normalization happens on the device in normalize_image().
     data_transform = T.Compose(
         [
             T.RandomResize([800], max_size=1333),
-            normalize,
+            T.ToUint8Tensor(),
         ]
     )
     cfg = SLConfig.fromfile("cfg_app.py")
@@ -125,8 +139,24 @@ def build_model_and_transforms(args):
 
     model.eval()
 
+    if args.compile:
+        # Default mode rather than "reduce-overhead": CUDA graphs reuse their output
+        # buffers, which would clobber the cached backbone features.
+        # Compile in place (torch >= 2.2): torch.compile() would wrap the Joiner, and
+        # forward() still indexes self.backbone[1].
+        model.backbone.compile(dynamic=False)
+        # Pad inputs to a fixed size so the compiled backbone only sees a few shapes
+        # (portrait, landscape, and square for mixed-orientation batches) per batch size.
+        model.pad_to_canonical_size = True
+
     return model, data_transform
 
+def warmup(model, transform, device):
+    # Pay the compile cost for both orientations before serving requests.
+    for size in [CANONICAL_SIZE[::-1], CANONICAL_SIZE]:
+        predict(model, transform, Image.new("RGB", size), "", None, device)
+    get_model_cache(model, "feature_cache", FEATURE_CACHE_SIZE).entries.clear()
+
 # APP:
 def get_box_inputs(prompts):
     box_inputs = []
@@ -143,42 +173,72 @@ def get_ind_to_filter(text, word_ids, keywords):
     keywords = keywords.split(",")
     keywords = [keyword.strip() for keyword in keywords]
 
+    word_positions = collections.defaultdict(list)
+    for ind, word in enumerate(input_words):
+        word_positions[word].append(ind)
+
     word_inds = []
     for keyword in keywords:
-        if keyword in input_words:
-            if len(word_inds) <= 0:
-                ind = input_words.index(keyword)
-                word_inds.append(ind)
-            else:
-                ind = input_words.index(keyword, word_inds[-1])
-                word_inds.append(ind)
+        if keyword in word_positions:
+            positions = word_positions[keyword]
+            start = word_inds[-1] if len(word_inds) > 0 else 0
+            # First occurrence at or after the previous keyword.
+            ind = bisect.bisect_left(positions, start)
+            if ind >= len(positions):
+                raise Exception("Keywords must appear in the input text in order!")
+            word_inds.append(positions[ind])
         else:
             raise Exception("Only specify keywords in the input text!")
 
-    inds_to_filter = []
-    for ind in range(len(word_ids)):
-        word_id = word_ids[ind]
-        if word_id in word_inds:
-            inds_to_filter.append(ind)
+    word_inds = set(word_inds)
+    inds_to_filter = [ind for ind, word_id in enumerate(word_ids) if word_id in word_inds]
 
     return inds_to_filter
 
+@functools.lru_cache(maxsize=16)
+def get_gaussian_kernel(sigma, device):
+    # Same truncation as scipy.ndimage.gaussian_filter (4 standard deviations).
+    radius = int(4 * sigma + 0.5)
+    kernel = torch.arange(-radius, radius + 1, device=device, dtype=torch.float32)
+    kernel = torch.exp(-(kernel ** 2) / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+@functools.lru_cache(maxsize=4)
+def get_colormap_lut(device):
+    # Imported on first use to keep matplotlib out of app start-up.
+    import matplotlib
+
+    # 256 x 3 lookup table of the jet colormap, in [0, 255].
+    lut = matplotlib.colormaps["jet"](np.linspace(0, 1, 256))[:, :3] * 255
+    return torch.as_tensor(lut, dtype=torch.float32, device=device)
+
 def generate_heatmap(image, boxes):
     # Plot results.
     (w, h) = image.size
-    det_map = np.zeros((h, w))
-    det_map[(h * boxes[:, 1]).astype(int), (w * boxes[:, 0]).astype(int)] = 1
-    det_map = ndimage.gaussian_filter(
-        det_map, sigma=(w // 200, w // 200), order=0
+    boxes = torch.as_tensor(boxes)
+    # Scatter the box centers and blur them on the device holding the boxes.
+    det_map = torch.zeros((1, 1, h, w), device=boxes.device)
+    inds = (h * boxes[:, 1]).long().clamp_(0, h - 1) * w + (w * boxes[:, 0]).long().clamp_(0, w - 1)
+    det_map.view(-1).index_put_(
+        (inds,), torch.ones_like(inds, dtype=det_map.dtype), accumulate=True
     )
-    plt.imshow(image)
-    plt.imshow(det_map[None, :].transpose(1, 2, 0), 'jet', interpolation='none', alpha=0.7)
-    plt.axis('off')
-    img_buf = io.BytesIO()
-    plt.savefig(img_buf, format='png', bbox_inches='tight')
-    plt.close()
-
-    output_img = Image.open(img_buf)
+    sigma = w // 200
+    if sigma > 0:
+        kernel = get_gaussian_kernel(sigma, boxes.device)
+        radius = kernel.shape[0] // 2
+        # Separable blur: horizontal pass, then vertical pass.
+        det_map = F.conv2d(det_map, kernel.view(1, 1, 1, -1), padding=(0, radius))
+        det_map = F.conv2d(det_map, kernel.view(1, 1, -1, 1), padding=(radius, 0))
+    # Stretch the density to [0, 1] as imshow does, then color it with the jet LUT.
+    det_map = det_map[0, 0]
+    det_map -= det_map.min()
+    det_map /= det_map.max().clamp_min(torch.finfo(det_map.dtype).tiny)
+    overlay = get_colormap_lut(boxes.device)[(det_map * 255).long()]
+
+    # Blend on the device and only copy the final image back.
+    pixels = torch.from_numpy(np.array(image.convert("RGB"))).to(boxes.device)
+    output = (0.3 * pixels + 0.7 * overlay).round_().to(torch.uint8)
+    output_img = Image.fromarray(output.cpu().numpy(), "RGB")
     return output_img
     
 def generate_output_label(text, num_exemplars):
@@ -207,42 +267,232 @@ def preprocess(transform, image, input_prompts = None):
     else:
         prompts = input_prompts
 
-    input_image, _ = transform(image, None)
     exemplar = get_box_inputs(prompts["points"])
     # Wrapping exemplar in a dictionary to apply only relevant transforms
-    input_image_exemplar, exemplar = transform(prompts['image'], {"exemplars": torch.tensor(exemplar)})
+    input_image_exemplar, exemplar = transform(prompts['image'], {"exemplars": torch.as_tensor(exemplar, dtype=torch.float32)})
     exemplar = exemplar["exemplars"]
+    if prompts['image'] is image:
+        # Same image, so reuse its transformed version instead of transforming it twice.
+        input_image = input_image_exemplar
+    else:
+        input_image, _ = transform(image, None)
 
     return input_image, input_image_exemplar, exemplar
 
-def get_boxes_from_prediction(model_output, text, keywords = ""):
-    ind_to_filter = get_ind_to_filter(text, model_output["token"][0].word_ids, keywords)
-    logits = model_output["pred_logits"].sigmoid()[0][:, ind_to_filter]
-    boxes = model_output["pred_boxes"][0]
+@functools.lru_cache(maxsize=4)
+def get_normalization_stats(device):
+    mean = torch.tensor(IMAGE_MEAN, device=device).view(3, 1, 1)
+    std = torch.tensor(IMAGE_STD, device=device).view(3, 1, 1)
+    return mean, std
+
+@functools.lru_cache(maxsize=4)
+def get_autocast_dtype(device):
+    # bf16 is only native from Ampere on; older GPUs such as the T4 use fp16.
+    if device.type == "cuda" and torch.cuda.get_device_capability(device) >= (8, 0):
+        return torch.bfloat16
+    return torch.float16
+
+@functools.lru_cache(maxsize=4)
+def get_zero_label(device):
+    return torch.zeros(1, dtype=torch.long, device=device)
+
+def normalize_image(image, device):
+    # Copy the HxWxC uint8 image to the device, then convert and normalize it there.
+    mean, std = get_normalization_stats(device)
+    image = image.to(device).permute(2, 0, 1).float()
+    return image.div_(255).sub_(mean).div_(std)
+
+def get_boxes_from_prediction(model_output, text, keywords = "", keep_device = False, sample_ind = 0):
+    ind_to_filter = get_ind_to_filter(text, model_output["token"][sample_ind].word_ids, keywords)
+    # Only the filtered token columns are needed, so slice before the sigmoid.
+    # Upcast in case the model ran under autocast.
+    logits = model_output["pred_logits"][sample_ind][:, ind_to_filter].float().sigmoid()
+    boxes = model_output["pred_boxes"][sample_ind].float()
     if len(keywords.strip()) > 0:
-        box_mask = (logits > CONF_THRESH).sum(dim=-1) == len(ind_to_filter)
+        box_mask = (logits > CONF_THRESH).all(dim=-1)
     else:
-        box_mask = logits.max(dim=-1).values > CONF_THRESH
-    boxes = boxes[box_mask, :].cpu().numpy()
-    logits = logits[box_mask, :].cpu().numpy()
+        box_mask = logits.amax(dim=-1) > CONF_THRESH
+    if keep_device:
+        return boxes[box_mask, :], logits[box_mask, :]
+    # Copy the kept boxes and logits to the host in a single transfer.
+    kept = torch.cat([boxes[box_mask, :], logits[box_mask, :]], dim=-1).cpu().numpy()
+    boxes = kept[:, :4]
+    logits = kept[:, 4:]
     return boxes, logits
 
-def predict(model, transform, image, text, prompts, device):
+class LRUCache(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+def get_model_cache(model, name, capacity):
+    # Caches live on the model so two loaded models never return each other's entries.
+    cache = getattr(model, name, None)
+    if cache is None:
+        cache = LRUCache(capacity)
+        setattr(model, name, cache)
+    return cache
+
+def get_image_key(image):
+    # Key on the resized HxWxC uint8 tensor the backbone sees, hashed in place
+    # without copying it.
+    key = hashlib.blake2b(image.contiguous().numpy(), digest_size=16)
+    key.update(str(tuple(image.shape)).encode())
+    return key.digest()
+
+def get_image_features(model, key, samples):
+    # Backbone outputs of recently seen images, so re-querying the same image with a
+    # different prompt skips the backbone.
+    feature_cache = get_model_cache(model, "feature_cache", FEATURE_CACHE_SIZE)
+    features = feature_cache.get(key)
+    if features is None:
+        features = model.encode_image(samples)
+        feature_cache.put(key, features)
+    return features
+
+def get_text_features(model, caption, device):
+    # Tokenized and encoded captions, so repeated queries with the same text skip the
+    # tokenizer and BERT.
+    text_cache = get_model_cache(model, "text_cache", TEXT_CACHE_SIZE)
+    text_features = text_cache.get(caption)
+    if text_features is None:
+        text_features = model.encode_text(model.tokenize([caption], device))
+        text_cache.put(caption, text_features)
+    return text_features
+
+@functools.lru_cache(maxsize=8)
+def get_padding_mask(size, padded_size, device):
+    # True on padded pixels, as in nested_tensor_from_tensor_list.
+    mask = torch.ones((1,) + padded_size, dtype=torch.bool, device=device)
+    mask[:, :size[0], :size[1]] = False
+    return mask
+
+def pad_to_canonical_size(images):
+    # images is a list (or batch tensor) of CxHxW images.
+    sizes = [tuple(image.shape[-2:]) for image in images]
+    size = (0, 0)
+    for (h, w) in sizes:
+        canonical_size = CANONICAL_SIZE if h <= w else CANONICAL_SIZE[::-1]
+        # Rounding in the resize can overshoot the long side by a pixel.
+        size = (max(size[0], canonical_size[0], h), max(size[1], canonical_size[1], w))
+    tensor = images[0].new_zeros((len(images), images[0].shape[0]) + size)
+    masks = []
+    for image, pad_image, (h, w) in zip(images, tensor, sizes):
+        pad_image[:, :h, :w].copy_(image)
+        masks.append(get_padding_mask((h, w), size, image.device))
+    mask = masks[0] if len(masks) == 1 else torch.cat(masks)
+    return NestedTensor(tensor, mask)
+
+def to_nested_tensor(model, images):
+    # images is a list (or batch tensor) of CxHxW images.
+    if getattr(model, "pad_to_canonical_size", False):
+        return pad_to_canonical_size(images)
+    if len(images) == 1:
+        # A single image needs no padding, so wrap it directly with a cached empty mask.
+        images = images[0].unsqueeze(0)
+        size = tuple(images.shape[-2:])
+        return NestedTensor(images, get_padding_mask(size, size, images.device))
+    return nested_tensor_from_tensor_list(images)
+
+@contextlib.contextmanager
+def inference_context(device):
+    # Run in half precision on CUDA; autocast keeps softmax and layer norms in fp32.
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type,
+        dtype=get_autocast_dtype(device),
+        enabled=device.type == "cuda",
+    ):
+        yield
+
+def prepare_inputs(model, inputs, device):
+    # inputs are (input_image, input_image_exemplar, exemplar) tuples from preprocess().
+    # An exemplar image that is the query image is only normalized and padded once.
+    input_images = []
+    input_image_exemplars = []
+    exemplars = []
+    for input_image, input_image_exemplar, exemplar in inputs:
+        input_images.append(normalize_image(input_image, device))
+        if input_image_exemplar is input_image:
+            input_image_exemplars.append(input_images[-1])
+        else:
+            input_image_exemplars.append(normalize_image(input_image_exemplar, device))
+        exemplars.append(exemplar.to(device))
+
+    # Pads the images to a common size and masks the padding.
+    samples = to_nested_tensor(model, input_images)
+    if all(exemplar_image is image for exemplar_image, image in zip(input_image_exemplars, input_images)):
+        exemplar_samples = samples
+    else:
+        exemplar_samples = to_nested_tensor(model, input_image_exemplars)
+    labels = [get_zero_label(device)] * len(input_images)
+
+    return samples, exemplar_samples, exemplars, labels
+
+def predict(model, transform, image, text, prompts, device, keep_device = False):
     keywords = "" # do not handle this for now
     input_image, input_image_exemplar, exemplar = preprocess(transform, image, prompts)
 
-    input_images = input_image.unsqueeze(0).to(device)
-    input_image_exemplars = input_image_exemplar.unsqueeze(0).to(device)
-    exemplars = [exemplar.to(device)]
-    
-    with torch.no_grad():
+    device = torch.device(device)
+    image_key = get_image_key(input_image)
+    if input_image_exemplar is input_image:
+        exemplar_image_key = image_key
+    else:
+        exemplar_image_key = get_image_key(input_image_exemplar)
+
+    with inference_context(device):
+        samples, exemplar_samples, exemplars, labels = prepare_inputs(
+            model, [(input_image, input_image_exemplar, exemplar)], device
+        )
         model_output = model(
-                nested_tensor_from_tensor_list(input_images),
-                nested_tensor_from_tensor_list(input_image_exemplars),
+                samples,
+                exemplar_samples,
                 exemplars,
-                [torch.tensor([0]).to(device) for _ in range(len(input_images))],
-                captions=[text + " ."] * len(input_images),
+                labels,
+                text_features=get_text_features(model, text + " .", device),
+                image_features=get_image_features(model, image_key, samples),
+                exemplar_image_features=get_image_features(model, exemplar_image_key, exemplar_samples),
             )
         
     keywords = ""
-    return get_boxes_from_prediction(model_output, text, keywords)
+    return get_boxes_from_prediction(model_output, text, keywords, keep_device)
+
+def predict_batch(model, transform, images, texts, prompts_list, device, keep_device = False):
+    keywords = "" # do not handle this for now
+    if prompts_list is None:
+        prompts_list = [None] * len(images)
+    if not len(images) == len(texts) == len(prompts_list):
+        raise ValueError("images, texts and prompts_list must have the same length")
+    inputs = [
+        preprocess(transform, image, prompts) for image, prompts in zip(images, prompts_list)
+    ]
+    # The model stacks exemplar tokens across the batch.
+    if len(set(exemplar.shape[0] for _, _, exemplar in inputs)) > 1:
+        raise Exception("All images in a batch must have the same number of visual exemplars!")
+
+    device = torch.device(device)
+    with inference_context(device):
+        samples, exemplar_samples, exemplars, labels = prepare_inputs(model, inputs, device)
+        model_output = model(
+                samples,
+                exemplar_samples,
+                exemplars,
+                labels,
+                captions=[text + " ." for text in texts],
+            )
+
+    return [
+        get_boxes_from_prediction(model_output, text, keywords, keep_device, sample_ind)
+        for sample_ind, text in enumerate(texts)
+    ]
@@ -4,6 +4,7 @@ Transforms and data augmentation for both image + bbox.
 """
 import random
 
+import numpy as np
 import PIL
 import torch
 import torchvision.transforms as T
@@ -292,6 +293,16 @@ class ToTensor(object):
         return F.to_tensor(img), target
 
 
+class ToUint8Tensor(object):
+    """
+    Converts a PIL image to an HxWxC uint8 tensor, leaving the float conversion
+    and normalization to the caller (e.g. on the GPU after the copy).
+    """
+
+    def __call__(self, img, target):
+        return torch.from_numpy(np.array(img, dtype=np.uint8)), target
+
+
 class RandomErasing(object):
     def __init__(self, *args, **kwargs):
         self.eraser = T.RandomErasing(*args, **kwargs)
@@ -42,7 +42,6 @@ from groundingdino.util.misc import (
     nested_tensor_from_tensor_list,
 )
 from groundingdino.util.utils import get_phrases_from_posmap
-from groundingdino.util.visualizer import COCOVisualizer
 from groundingdino.util.vl_utils import create_positive_map_from_span
 
 from ..registry import MODULE_BUILD_FUNCS
@@ -57,9 +56,6 @@ from .utils import MLP, ContrastiveEmbed, sigmoid_focal_loss
 
 from .matcher import build_matcher
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-from groundingdino.util.visualizer import renorm
 
 
 def numpy_2_cv2(np_img):
@@ -74,8 +70,18 @@ def numpy_2_cv2(np_img):
 
 
 def vis_exemps(image, exemp, f_name):
-    plt.imshow(image)
-    plt.gca().add_patch(
+    # Debug-only, so matplotlib is imported here rather than at model import time.
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Rectangle
+
+    # Use a standalone figure rather than pyplot's global state, so this is cheap
+    # and safe to call from concurrent requests.
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.imshow(image)
+    ax.add_patch(
         Rectangle(
             (exemp[0], exemp[1]),
             exemp[2] - exemp[0],
@@ -85,8 +91,7 @@ def vis_exemps(image, exemp, f_name):
             lw=1,
         )
     )
-    plt.savefig(f_name)
-    plt.close()
+    canvas.print_figure(f_name)
 
 
 class GroundingDINO(nn.Module):
@@ -323,8 +328,17 @@ class GroundingDINO(nn.Module):
                     ]
                 )
             )
+            # Keep padding tokens masked; only the inserted exemplar tokens are new.
             new_text_token_mask.append(
-                torch.full((len(new_input_ids[sample_ind]),), True).to(device)
+                torch.cat(
+                    [
+                        text_token_mask[sample_ind][:ind_to_insert_exemplar],
+                        torch.ones(
+                            exemplars.shape[0], dtype=torch.bool, device=device
+                        ),
+                        text_token_mask[sample_ind][ind_to_insert_exemplar:],
+                    ]
+                )
             )
 
         tokenized["input_ids"] = torch.stack(new_input_ids)
@@ -369,46 +383,21 @@ class GroundingDINO(nn.Module):
 
         return x
 
-    def forward(
-        self,
-        samples: NestedTensor,
-        exemplar_images: NestedTensor,
-        exemplars: List,
-        labels,
-        targets: List = None,
-        cropped=False,
-        orig_img=None,
-        crop_width=0,
-        crop_height=0,
-        **kw,
-    ):
-        """The forward expects a NestedTensor, which consists of:
-           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
-           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
-
-        It returns a dict with the following elements:
-           - "pred_logits": the classification logits (including no-object) for all queries.
-                            Shape= [batch_size x num_queries x num_classes]
-           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
-                           (center_x, center_y, width, height). These values are normalized in [0, 1],
-                           relative to the size of each individual image (disregarding possible padding).
-                           See PostProcess for information on how to retrieve the unnormalized bounding box.
-           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
-                            dictionnaries containing the two above keys for each decoder layer.
-        """
-
-        if targets is None:
-            captions = kw["captions"]
-        else:
-            captions = [t["caption"] for t in targets]
-
-        # encoder texts
-
-        tokenized = self.tokenizer(captions, padding="longest", return_tensors="pt").to(
-            samples.device
+    def tokenize(self, captions: List[str], device):
+        """Tokenizes captions; the result can be passed to forward() as tokenized."""
+        return self.tokenizer(captions, padding="longest", return_tensors="pt").to(
+            device
         )
 
-        one_hot_token = tokenized
+    def encode_text(self, tokenized):
+        """Encodes tokenized captions with the text backbone.
+
+        Returns (tokenized, text_dict), with tokenized truncated to max_text_len.
+        The result can be passed to forward() as text_features to skip BERT for a
+        repeated caption.
+        """
+        # Shallow copy, since entries of tokenized are replaced below.
+        tokenized = copy.copy(tokenized)
 
         (
             text_self_attention_masks,
@@ -465,12 +454,79 @@ class GroundingDINO(nn.Module):
             "text_self_attention_masks": text_self_attention_masks,  # bs, 195,195
         }
 
+        return tokenized, text_dict
+
+    def encode_image(self, samples: NestedTensor):
+        """Runs the backbone and returns its (features, poss) outputs.
+
+        The result can be passed back to forward() as image_features or
+        exemplar_image_features to skip the backbone for a repeated image.
+        """
+        return self.backbone(samples)
+
+    def forward(
+        self,
+        samples: NestedTensor,
+        exemplar_images: NestedTensor,
+        exemplars: List,
+        labels,
+        targets: List = None,
+        cropped=False,
+        orig_img=None,
+        crop_width=0,
+        crop_height=0,
+        image_features=None,
+        exemplar_image_features=None,
+        tokenized=None,
+        text_features=None,
+        **kw,
+    ):
+        """The forward expects a NestedTensor, which consists of:
+           - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
+           - samples.mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+
+        It returns a dict with the following elements:
+           - "pred_logits": the classification logits (including no-object) for all queries.
+                            Shape= [batch_size x num_queries x num_classes]
+           - "pred_boxes": The normalized boxes coordinates for all queries, represented as
+                           (center_x, center_y, width, height). These values are normalized in [0, 1],
+                           relative to the size of each individual image (disregarding possible padding).
+                           See PostProcess for information on how to retrieve the unnormalized bounding box.
+           - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
+                            dictionnaries containing the two above keys for each decoder layer.
+        """
+
+        # encoder texts
+        if text_features is None:
+            if tokenized is None:
+                if targets is None:
+                    captions = kw["captions"]
+                else:
+                    captions = [t["caption"] for t in targets]
+
+                tokenized = self.tokenize(captions, samples.device)
+            text_features = self.encode_text(tokenized)
+
+        tokenized, text_dict = text_features
+        # Shallow copies, since add_exemplar_tokens replaces input_ids below and the
+        # transformer replaces text_dict["encoded_text"] with its fused output.
+        tokenized = copy.copy(tokenized)
+        text_dict = dict(text_dict)
+        one_hot_token = tokenized
+
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
 
         if not cropped:
-            features, poss = self.backbone(samples)
-            features_exemp, _ = self.backbone(exemplar_images)
+            if image_features is None:
+                features, poss = self.backbone(samples)
+            else:
+                # Copy poss since the extra feature levels are appended to it below.
+                features, poss = image_features[0], list(image_features[1])
+            if exemplar_image_features is None:
+                features_exemp, _ = self.backbone(exemplar_images)
+            else:
+                features_exemp = exemplar_image_features[0]
             combined_features = self.combine_features(features_exemp)
             # Get visual exemplar tokens.
             bs = len(exemplars)
@@ -493,6 +549,10 @@ class GroundingDINO(nn.Module):
 
 
         else:
+            # The visualizer pulls in matplotlib.pyplot, so only import it on this
+            # debug path.
+            from groundingdino.util.visualizer import renorm
+
             features, poss = self.backbone(samples)
             (h, w) = (
                 samples.decompose()[0][0].shape[1],
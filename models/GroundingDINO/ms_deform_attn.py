@@ -328,8 +328,10 @@ class MultiScaleDeformableAttention(nn.Module):
             )
     
         if torch.cuda.is_available() and value.is_cuda:
+            # The CUDA kernel only supports fp32, so upcast fp16/bf16 (e.g. under autocast).
             halffloat = False
-            if value.dtype == torch.float16:
+            value_dtype = value.dtype
+            if value_dtype in (torch.float16, torch.bfloat16):
                 halffloat = True
                 value = value.float()
                 sampling_locations = sampling_locations.float()
@@ -345,7 +347,7 @@ class MultiScaleDeformableAttention(nn.Module):
             )
 
             if halffloat:
-                output = output.half()
+                output = output.to(value_dtype)
         else:
             output = multi_scale_deformable_attn_pytorch(
                 value, spatial_shapes, sampling_locations, attention_weights